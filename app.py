@@ -1,14 +1,17 @@
 import streamlit as st
 import os
-import io
+import subprocess
 import tempfile
+import concurrent.futures
 import datetime
-import base64
 import re
 import json
-import gspread
+import hashlib
+import heapq
 import google.generativeai as genai
-from google.cloud import speech
+# v1p1beta1はMP3エンコーディングを明示指定できる（ヘッダ推定より確実・高速）
+from google.cloud import speech_v1p1beta1 as speech
+from google.cloud import storage
 from google.oauth2 import service_account
 import streamlit.components.v1 as components
 
@@ -61,6 +64,14 @@ def load_credentials():
 # 認証情報をロード
 gemini_api_key, google_creds_dict = load_credentials()
 
+@st.cache_resource(ttl=3600)
+def list_generate_models():
+    """generateContent対応モデル名の一覧を取得する（1時間キャッシュ）"""
+    return [
+        m.name for m in genai.list_models()
+        if 'generateContent' in m.supported_generation_methods
+    ]
+
 # --- サイドバー：システム診断ツール（パスワード保護付き） ---
 with st.sidebar:
     st.header("🔧 管理者メニュー")
@@ -85,11 +96,11 @@ with st.sidebar:
         if st.button("API接続テスト & モデル一覧取得"):
             with st.spinner("問い合わせ中..."):
                 try:
-                    available_models = []
-                    for m in genai.list_models():
-                        if 'generateContent' in m.supported_generation_methods:
-                            available_models.append(m.name)
-                    
+                    # 接続テストなのでキャッシュを破棄して取り直す
+                    # （結果はキャッシュに載るので、後段のモデル解決はRTTを払わない）
+                    list_generate_models.clear()
+                    available_models = list_generate_models()
+
                     if available_models:
                         st.success(f"✅ API接続成功！ ({len(available_models)}個のモデルを検出)")
                         with st.expander("利用可能なモデル一覧"):
@@ -107,41 +118,373 @@ with st.sidebar:
 
 # --- 関数群 ---
 
+# 静的なCSS/HTML断片は毎回組み立てずモジュール定数として1回だけ構築する
+STICKY_PLAYER_CSS = """
+<style>
+.st-key-sticky_player {
+    position: fixed;
+    bottom: 0;
+    left: 0;
+    width: 100%;
+    background-color: #f1f3f5;
+    border-top: 1px solid #dee2e6;
+    padding: 10px 0;
+    text-align: center;
+    box-shadow: 0 -2px 10px rgba(0,0,0,0.1);
+    z-index: 999999;
+}
+</style>
+"""
+
+STICKY_PLAYER_LABEL = '<div style="font-size:12px;color:#666;margin-bottom:4px;font-weight:bold;">🔊 音声プレーヤー (レポート閲覧中もここに固定されます)</div>'
+
+NO_LOW_CONF_HTML = "<div style='color:#666;padding:10px;'>✅ 低信頼度の箇所なし（明瞭な発音）</div>"
+
+FOOTER_HTML = """
+<div style="text-align: center; color: #666; font-size: 0.8em;">
+    Mirait Japanese Academy 日本語音声指導補助ツール v7.1 | Powered by Google Cloud Speech-to-Text & Gemini AI
+</div>
+"""
+
+# ffmpeg変換コマンド（stdin→stdoutパイプ、16kHzモノラルFLAC）
+# MP3のLAMEエンコードは変換の最重量ステージ。STTにしか渡さない音声なので
+# ロスレスで高速なFLACにし、32kbps MP3由来の音質劣化も避ける
+# -threads 0: 長尺動画のデコードをlibavcodecに並列化させる
+# -compression_level 0: STTに渡すだけの音声なのでFLAC圧縮は最速設定でよい
+FFMPEG_CMD = [
+    "ffmpeg", "-threads", "0", "-y", "-i", "pipe:0",
+    "-vn", "-ac", "1", "-ar", "16000",
+    "-compression_level", "0",
+    "-f", "flac", "pipe:1", "-loglevel", "error"
+]
+
+# 入力形式の確認用（コーデック・サンプルレート・チャンネル数・コンテナ・長さ）
+FFPROBE_CMD = [
+    "ffprobe", "-v", "error", "-select_streams", "a:0",
+    "-show_entries", "stream=codec_name,sample_rate,channels:format=format_name,duration",
+    "-of", "default=noprint_wrappers=1", "pipe:0"
+]
+
+# 優先順のモデルリスト（診断結果に基づいた、確実に動くモデル）
+TARGET_MODELS = [
+    "gemini-2.0-flash",       # 最新・高速・高性能
+    "gemini-2.0-flash-lite",
+    "gemini-1.5-flash",
+    "gemini-pro"
+]
+
+@st.cache_resource(ttl=3600)
+def resolve_gemini_models():
+    """利用可能なモデルを一度だけ問い合わせ、優先順のリストを返す（失敗時は既定リスト）"""
+    try:
+        available = {name.removeprefix("models/") for name in list_generate_models()}
+        ordered = [name for name in TARGET_MODELS if name in available]
+        return ordered or TARGET_MODELS
+    except Exception:
+        # 問い合わせ失敗時は既定リストで順に試す（従来動作）
+        return TARGET_MODELS
+
+@st.cache_resource
+def get_gemini_model(model_name):
+    """GenerativeModelを一度だけ構築して使い回す（内部クライアントの再生成を防ぐ）
+
+    固定の指示文はsystem_instructionとして渡す。毎回のcontentsが可変部だけに
+    なるので、明示キャッシュが使えないモデルでも安定プレフィックスとして
+    サーバ側のプロンプトキャッシュが効きやすい。
+    """
+    return genai.GenerativeModel(model_name, system_instruction=PROMPT_RUBRIC)
+
+# 固定の指示文（毎回変わるのは学習者情報と分析データのみ）
+# プレフィル短縮のため冗長な言い回しは削ってあるが、自動抽出が依存する
+# 出力形式ブロックは一字一句維持すること
+PROMPT_RUBRIC = """
+あなたは日本語音声学・対照言語学・日本語教育の専門家です。
+与えられる認識結果と単語別信頼度から、教師向けの音声評価レポートを作成してください。
+
+【重要指示】
+1. **分節音（母音・子音）**: 信頼度が低い箇所（⚠️マーク）を発音ミスとして、母語の干渉を考慮して分析。「要重点指導音」はIPAとひらがなを併記。
+2. **超分節音（プロソディ）**: 以下の3点を独立した項目として評価。
+   - **拍と音節**: モーラの等時性。特殊拍（長音・促音・撥音）が短くなっていないか。
+   - **韻律とフット**: 2モーラ1フット傾向とリズムの自然さ。
+   - **アクセントとイントネーション**: ピッチアクセントの正誤、文末・句末イントネーションの適切さ。
+
+【出力形式（厳守）】
+レポート冒頭に以下のサマリーを必ず含め、**自動抽出のため項目の形式を変えないこと**。
+
+### 【総合評価サマリー】
+* **総合音声スコア**： [0~100の数値]
+* **明瞭度**： [S/A/B/C]
+* **日本語らしさ**： [S/A/B/C]
+* **要重点指導音**： [音声記号とひらがなを併記]
+
+---
+
+### 【詳細分析レポート】
+
+#### 1. 分節音レベルの評価
+
+#### 2. プロソディ（超分節音）レベルの評価
+* **拍と音節**:
+* **韻律とフット**:
+* **アクセントとイントネーション**:
+
+#### 3. 指導アドバイス・練習計画
+"""
+
+@st.cache_resource(ttl=3600)
+def get_cached_rubric(model_name):
+    """固定の指示文をGeminiのコンテキストキャッシュに載せる（非対応モデル等ではNone）"""
+    try:
+        return genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=PROMPT_RUBRIC,
+            ttl=datetime.timedelta(hours=1)
+        )
+    except Exception:
+        # キャッシュ最小トークン数未満・非対応モデルの場合は毎回プロンプトに含める
+        return None
+
 def get_jst_now():
     """現在時刻を日本時間(JST)で取得する"""
     t_delta = datetime.timedelta(hours=9)
     JST = datetime.timezone(t_delta, 'JST')
     return datetime.datetime.now(JST)
 
-def analyze_audio(source_path):
-    """音声認識を実行"""
+@st.cache_resource
+def get_speech_client():
+    """Speech-to-Textクライアントを一度だけ構築して使い回す（認証とgRPCチャネルを共有）"""
+    credentials = service_account.Credentials.from_service_account_info(
+        google_creds_dict
+    )
+    return speech.SpeechClient(credentials=credentials)
+
+
+# ストリーミング認識の対象上限（秒）。API上限5分に余裕を持たせる
+STREAMING_LIMIT_SECONDS = 290
+
+
+def convert_via_tempfile(audio_bytes):
+    """パイプ変換に失敗した入力の退避経路（失敗時はNone）
+
+    MP4/MOV等はmoovアトムがファイル末尾にあるとシーク可能な入力が必要で、
+    pipe:0からはdemuxできないことがある。その場合だけ一時ファイルを経由する。
+    """
     try:
-        credentials = service_account.Credentials.from_service_account_info(
-            google_creds_dict
+        with tempfile.NamedTemporaryFile(suffix=".bin") as tmp:
+            tmp.write(audio_bytes)
+            tmp.flush()
+            cmd = [arg if arg != "pipe:0" else tmp.name for arg in FFMPEG_CMD]
+            proc = subprocess.run(cmd, capture_output=True)
+        if proc.returncode != 0:
+            return None
+        return proc.stdout or None
+    except Exception:
+        return None
+
+
+def probe_audio(audio_bytes):
+    """ffprobeで入力音声の形式・長さを調べる（失敗時は空のdict）"""
+    try:
+        proc = subprocess.run(
+            FFPROBE_CMD,
+            input=audio_bytes,
+            capture_output=True,
+            timeout=30
         )
-        client = speech.SpeechClient(credentials=credentials)
+        if proc.returncode != 0:
+            return {}
+        info = {}
+        for line in proc.stdout.decode("utf-8", "replace").splitlines():
+            if "=" in line:
+                key, _, value = line.partition("=")
+                info[key.strip()] = value.strip()
+        return info
+    except Exception:
+        return {}
+
+
+def streaming_recognize(client, config, content, progress_callback=None):
+    """gRPCストリーミング認識を実行し、確定した結果のリストを返す
+
+    progress_callbackを渡すと、認識の途中経過（確定済み＋暫定テキスト）が
+    届くたびに呼び出されるので、UI側で逐次表示できる。
+    """
+    streaming_config = speech.StreamingRecognitionConfig(
+        config=config,
+        interim_results=progress_callback is not None
+    )
+
+    def audio_chunks():
+        chunk_size = 16 * 1024
+        for i in range(0, len(content), chunk_size):
+            yield speech.StreamingRecognizeRequest(audio_content=content[i:i + chunk_size])
+
+    final_results = []
+    confirmed = ""
+    responses = client.streaming_recognize(config=streaming_config, requests=audio_chunks())
+    for resp in responses:
+        for result in resp.results:
+            if result.is_final:
+                final_results.append(result)
+                confirmed += result.alternatives[0].transcript
+                if progress_callback:
+                    progress_callback(confirmed)
+            elif progress_callback and result.alternatives:
+                progress_callback(confirmed + result.alternatives[0].transcript)
+
+    return final_results
+
+
+@st.cache_resource
+def get_storage_client():
+    """GCSクライアントを使い回す（長時間音声のURI渡し用）"""
+    credentials = service_account.Credentials.from_service_account_info(
+        google_creds_dict
+    )
+    return storage.Client(
+        credentials=credentials,
+        project=google_creds_dict.get("project_id")
+    )
+
+
+def recognize_long_audio(client, config, content):
+    """長時間音声のLRO認識。GCS_BUCKET設定時はURI渡しでインラインアップロードを避ける"""
+    bucket_name = st.secrets.get("GCS_BUCKET")
+    if not bucket_name:
+        operation = client.long_running_recognize(
+            config=config,
+            audio=speech.RecognitionAudio(content=content)
+        )
+        return operation.result(timeout=600)
+
+    blob = get_storage_client().bucket(bucket_name).blob(
+        f"stt-tmp/{hashlib.blake2b(content, digest_size=16).hexdigest()}.audio"
+    )
+    try:
+        blob.upload_from_string(content, content_type="application/octet-stream")
+        operation = client.long_running_recognize(
+            config=config,
+            audio=speech.RecognitionAudio(uri=f"gs://{bucket_name}/{blob.name}")
+        )
+        return operation.result(timeout=600)
+    finally:
+        try:
+            blob.delete()
+        except Exception:
+            pass
+
+
+# 並列チャンク認識の分割長（秒）。同期APIの60秒上限に収める
+CHUNK_SECONDS = 55
+
+
+def recognize_in_chunks(client, config, content):
+    """5分を超える音声をチャンクに分割し、同期APIへ並列投入する
+
+    GCSバケット未設定時のLRO代替。固定長で切るため境界の単語が分断され
+    得るが、1本のLROを待つより壁時計時間は大幅に短い。
+    戻り値は(認識結果, オフセット秒)のリスト。
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src_path = os.path.join(tmpdir, "src.audio")
+        with open(src_path, "wb") as f:
+            f.write(content)
+
+        pattern = os.path.join(tmpdir, "chunk%04d.flac")
+        cmd = [
+            "ffmpeg", "-y", "-i", src_path,
+            "-f", "segment", "-segment_time", str(CHUNK_SECONDS),
+            "-c:a", "flac", "-compression_level", "0",
+            pattern, "-loglevel", "panic"
+        ]
+        proc = subprocess.run(cmd, capture_output=True)
+        if proc.returncode != 0:
+            raise RuntimeError("音声の分割に失敗しました")
+
+        chunk_bytes = []
+        for name in sorted(os.listdir(tmpdir)):
+            if name.startswith("chunk"):
+                with open(os.path.join(tmpdir, name), "rb") as f:
+                    chunk_bytes.append(f.read())
+
+    # セグメントはFLACで出力されるため、呼び出し元のencoding（MP3パススルー等）を
+    # 引き継がず、チャンク用のconfigではFLACを明示する
+    chunk_config = speech.RecognitionConfig(config)
+    chunk_config.encoding = speech.RecognitionConfig.AudioEncoding.FLAC
+
+    def recognize_chunk(data):
+        return client.recognize(
+            config=chunk_config, audio=speech.RecognitionAudio(content=data)
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(recognize_chunk, chunk_bytes))
+
+    results = []
+    for idx, resp in enumerate(responses):
+        offset = idx * float(CHUNK_SECONDS)
+        for r in resp.results:
+            results.append((r, offset))
+    return results
+
+
+def analyze_audio(audio_bytes, progress_callback=None):
+    """音声認識を実行"""
+    try:
+        client = get_speech_client()
     except Exception as e:
         return {"error": f"認証エラー: {e}"}
 
-    # 一時ファイルで変換
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_converted:
-        converted_path = tmp_converted.name
-    
-    # ffmpegで変換
-    cmd = f'ffmpeg -y -i "{source_path}" -vn -ac 1 -ar 16000 -ab 32k "{converted_path}" -loglevel panic'
-    exit_code = os.system(cmd)
-    
-    if exit_code != 0:
-        return {"error": "ファイル変換エラー (FFmpeg未インストールの可能性)"}
+    # 既にSpeech APIへそのまま渡せる形式（16kHzモノラルのMP3/FLAC/WAV）なら
+    # 再エンコードを省いてそのまま送る。コーデックだけでなくコンテナも確認する
+    # （MP4/MOV等は音声トラックが適合していてもAPI側でdemuxできない）
+    info = probe_audio(audio_bytes)
+    codec = info.get("codec_name")
+    if (info.get("format_name") in ("mp3", "flac", "wav")
+            and codec in ("mp3", "flac", "pcm_s16le")
+            and info.get("sample_rate") == "16000"
+            and info.get("channels") == "1"):
+        content = audio_bytes
+        if codec == "flac":
+            encoding = speech.RecognitionConfig.AudioEncoding.FLAC
+            audio_format = "audio/flac"
+        elif codec == "mp3":
+            encoding = speech.RecognitionConfig.AudioEncoding.MP3
+            audio_format = "audio/mp3"
+        else:
+            # WAVはヘッダからの自動判別に任せる
+            encoding = speech.RecognitionConfig.AudioEncoding.ENCODING_UNSPECIFIED
+            audio_format = "audio/wav"
+    else:
+        # ffmpegで変換（stdin/stdoutパイプ：一時ファイルとシェル起動を介さない）
+        try:
+            proc = subprocess.Popen(
+                FFMPEG_CMD,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=1024 * 1024
+            )
+            content, ffmpeg_err = proc.communicate(audio_bytes)
+        except FileNotFoundError:
+            return {"error": "ファイル変換エラー (FFmpeg未インストールの可能性)"}
+
+        if proc.returncode != 0 or not content:
+            # 動画コンテナ等、パイプ入力でdemuxできないものは一時ファイル経由で再試行
+            content = convert_via_tempfile(audio_bytes)
+            if not content:
+                # 原因の切り分けができるようffmpegの診断メッセージ末尾を添える
+                detail = ffmpeg_err.decode(errors="replace")[-300:].strip()
+                return {"error": f"ファイル変換エラー: {detail or '原因不明'}"}
+
+        encoding = speech.RecognitionConfig.AudioEncoding.FLAC
+        audio_format = "audio/flac"
 
     # 音声認識
     try:
-        with io.open(converted_path, "rb") as f:
-            content = f.read()
-        
         audio = speech.RecognitionAudio(content=content)
         config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.ENCODING_UNSPECIFIED,
+            encoding=encoding,
             sample_rate_hertz=16000,
             language_code="ja-JP",
             enable_automatic_punctuation=False,
@@ -150,69 +493,159 @@ def analyze_audio(source_path):
             enable_word_time_offsets=True
         )
         
-        operation = client.long_running_recognize(config=config, audio=audio)
-        response = operation.result(timeout=600)
-        
+        # 音声の長さでAPIを使い分ける：60秒以下はLROポーリングを省ける同期API
+        # （余裕を見て55秒で判定）、5分以内はストリーミング認識でアップロードと
+        # 認識をオーバーラップ、それ以上はLRO。長さはffprobeの値を優先し、
+        # 取れなければ16kHzモノラルFLACの概算（約18,000バイト/秒）で代用する。
+        try:
+            duration = float(info["duration"])
+        except (KeyError, ValueError):
+            duration = len(content) / 18000
+
+        # resultsは(認識結果, オフセット秒)のリストに正規化する
+        # （並列チャンク認識ではチャンク先頭からの相対時刻しか得られないため）
+        if duration <= 55:
+            response = client.recognize(config=config, audio=audio)
+            results = [(r, 0.0) for r in response.results]
+        elif duration <= STREAMING_LIMIT_SECONDS:
+            finals = streaming_recognize(client, config, content, progress_callback)
+            results = [(r, 0.0) for r in finals]
+        elif st.secrets.get("GCS_BUCKET"):
+            response = recognize_long_audio(client, config, content)
+            results = [(r, 0.0) for r in response.results]
+        else:
+            results = recognize_in_chunks(client, config, content)
+
     except Exception as e:
         return {"error": f"認識エラー: {e}"}
-    finally:
-        if os.path.exists(converted_path):
-            os.remove(converted_path)
 
-    if not response.results:
+    if not results:
         return {"error": "音声認識不可(無音/ノイズ)"}
 
     # 結果の整形
-    full_transcript = ""
-    full_details = []
-    word_data_list = []
-    
-    for result in response.results:
-        alt = result.alternatives[0]
-        full_transcript += alt.transcript
-        
-        for w in alt.words:
-            score = int(w.confidence * 100)
-            start_seconds = w.start_time.total_seconds()
-            time_str = f"[{start_seconds:.1f}s]"
-            marker = " ⚠️" if w.confidence < 0.8 else ""
-            
-            full_details.append(f"{w.word}({score}){time_str}{marker}")
-            word_data_list.append({
-                "word": w.word, 
-                "conf": w.confidence, 
-                "start": start_seconds
-            })
-            
+    full_transcript = "".join(
+        result.alternatives[0].transcript for result, _ in results
+    )
+
+    # 単語データを1パスでフラットに抽出し、詳細文字列は1回のjoinで組み立てる
+    # 信頼度は表示・判定とも百分率の整数しか使わないため、取り込み時に一度だけ量子化する
+    word_data_list = [
+        {
+            "word": w.word,
+            "conf": round(w.confidence * 100),
+            "start": w.start_time.total_seconds() + offset
+        }
+        for result, offset in results
+        for w in result.alternatives[0].words
+    ]
+    details = ", ".join(format_word_detail(d) for d in word_data_list)
+
+    # 低信頼度の単語はここで1回だけ抽出し、描画側では再走査しない
+    low_conf_words = [d for d in word_data_list if d["conf"] < LOW_CONF_THRESHOLD]
+
     return {
         "main_text": full_transcript,
-        "details": ", ".join(full_details),
+        "details": details,
+        "low_conf_words": low_conf_words,
         "audio_content": content,
+        "audio_format": audio_format,
         "word_data": word_data_list,
         "alts": ""
     }
 
 
+# 低信頼度とみなす信頼度（百分率）のしきい値
+LOW_CONF_THRESHOLD = 80
+
+
+def format_word_detail(d):
+    """単語1語分の詳細表記：語(信頼度)[開始秒]、低信頼度には⚠️を付ける"""
+    return (
+        f"{d['word']}({d['conf']})[{d['start']:.1f}s]"
+        f"{' ⚠️' if d['conf'] < LOW_CONF_THRESHOLD else ''}"
+    )
+
+
+# プロンプトに載せる単語詳細の上限。これを超える長尺音声では
+# 信頼度の低い順に間引いてGeminiのトークン消費を抑える
+PROMPT_DETAIL_WORD_LIMIT = 150
+
+
+def details_for_prompt(word_data, details):
+    """プロンプト用の詳細スコア文字列（長尺は低信頼度の単語を優先して切り詰める）"""
+    if len(word_data) <= PROMPT_DETAIL_WORD_LIMIT:
+        return details
+    worst = heapq.nsmallest(
+        PROMPT_DETAIL_WORD_LIMIT, word_data, key=lambda d: d["conf"]
+    )
+    worst.sort(key=lambda d: d["start"])
+    return ", ".join(format_word_detail(d) for d in worst)
+
+
+class AnalysisError(Exception):
+    """音声認識の失敗。例外で抜けることでst.cache_dataに失敗を記憶させない"""
+
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def cached_analyze_audio(audio_sha, _audio_bytes, _progress_callback=None):
+    """同一音声の再分析をスキップする（キーは音声バイト列のハッシュ）
+
+    一時的な失敗（認証・API障害等）を1時間キャッシュしてしまうと
+    再クリックで再試行できなくなるため、エラーは例外として投げ直す。
+    """
+    res = analyze_audio(_audio_bytes, _progress_callback)
+    if "error" in res:
+        raise AnalysisError(res["error"])
+    return res
+
+
+# 生成失敗時にレポートへ埋め込む目印（これを含む結果はキャッシュしない）
+GEMINI_ERROR_PREFIX = "❌ Gemini生成エラー"
+
+
+@st.cache_resource
+def get_report_cache():
+    """生成済みレポートのプロセス内キャッシュ"""
+    return {}
+
+
+def stream_report(student_name, nationality, text, alts, details):
+    """レポートをチャンク単位で逐次返す。生成済みの同一入力は一括で返す"""
+    key = hashlib.blake2b(
+        repr((student_name, nationality, text, alts, details)).encode(),
+        digest_size=16
+    ).hexdigest()
+    cache = get_report_cache()
+
+    if key in cache:
+        yield cache[key]
+        return
+
+    parts = []
+    for chunk_text in ask_gemini(student_name, nationality, text, alts, details):
+        parts.append(chunk_text)
+        yield chunk_text
+
+    report = "".join(parts)
+
+    # 失敗レポートを覚えると同じ入力はプロセス存続中ずっと再試行できなくなる
+    if GEMINI_ERROR_PREFIX in report:
+        return
+
+    if len(cache) > 64:
+        cache.clear()
+    cache[key] = report
+
+
 def ask_gemini(student_name, nationality, text, alts, details):
-    """Gemini APIで音声評価レポートを生成"""
-    
-    # 診断結果に基づいた、確実に動くモデルリスト
-    target_models = [
-        "gemini-2.0-flash",       # 最新・高速・高性能
-        "gemini-2.0-flash-lite",
-        "gemini-1.5-flash",
-        "gemini-pro"
-    ]
-    
+    """Gemini APIで音声評価レポートをストリーミング生成するジェネレータ"""
     last_error = None
     
     name_part = f"学習者名は「{student_name}」です。" if student_name else "学習者名は不明です。"
     nat_instruction = f"学習者の母語・国籍は「{nationality}」です。" if nationality else "母語情報は不明です。"
 
-    prompt = f"""
-あなたは日本語音声学・対照言語学・日本語教育の高度な専門家です。
-以下のデータに基づき、教師向けの専門的な音声評価レポートを作成してください。
-
+    # 毎回変わるのはこのブロックだけ（固定の指示文はPROMPT_RUBRIC）
+    variable_block = f"""
 【基本情報】
 {name_part}
 {nat_instruction}
@@ -220,91 +653,99 @@ def ask_gemini(student_name, nationality, text, alts, details):
 【分析データ】
 認識結果: {text}
 詳細スコア: {details}
+"""
 
-【重要指示】
-1. **分節音（母音・子音）の分析**:
-   - 信頼度が低い箇所（⚠️マーク）を発音ミスとして分析してください。
-   - 母語の干渉（母語の音韻体系の影響）を考慮してください。
-   - 「要重点指導音」には、音声記号（IPA）と対応する日本語（ひらがな等）を併記してください。
+    # 前回成功したモデルを先頭に回す（失敗するモデルの再試行で待たされない）
+    model_names = resolve_gemini_models()
+    try:
+        preferred = st.session_state.get("gemini_model")
+    except Exception:
+        preferred = None  # ワーカースレッドからはセッションにアクセスできない
+    if preferred in model_names:
+        model_names = [preferred] + [m for m in model_names if m != preferred]
 
-2. **超分節音（プロソディ）の分析**:
-   以下の3点を独立した項目として詳細に評価してください。
-   - **拍と音節 (Mora vs Syllable)**: 日本語のモーラ感覚（等時性）が保たれているか。特殊拍（長音・促音・撥音）が短くなっていないか。
-   - **韻律とフット (Rhythm & Foot)**: 日本語のフット構造（2モーラ1フットの傾向）やリズムの自然さ。
-   - **アクセントとイントネーション**: 語彙のピッチアクセントの正誤、および文末・句末のイントネーション（上昇・下降）の適切さ。
+    for model_name in model_names:
+        yielded = False
+        try:
+            cache = get_cached_rubric(model_name)
+            if cache is not None:
+                model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+            else:
+                # 指示文はモデル側のsystem_instructionに載っているので可変部のみ送る
+                model = get_gemini_model(model_name)
 
-【出力形式（厳守）】
-レポートの冒頭に以下のサマリーを必ず含めてください。
-**注意：自動抽出のため、項目の形式を変えないでください。**
+            # ハングしたモデルで無期限に待たず、タイムアウト後に次へフォールバック
+            response = model.generate_content(
+                variable_block, stream=True, request_options={"timeout": 45}
+            )
 
-### 【総合評価サマリー】
-* **総合音声スコア**： [0~100の数値]
-* **明瞭度**： [S/A/B/C]
-* **日本語らしさ**： [S/A/B/C]
-* **要重点指導音**： [音声記号とひらがなを併記]
+            for chunk in response:
+                if chunk.text:
+                    yielded = True
+                    yield chunk.text
+            try:
+                st.session_state["gemini_model"] = model_name
+            except Exception:
+                pass
+            return
 
----
+        except Exception as e:
+            last_error = e
+            if yielded:
+                # 出力済みの途中結果に別モデルの全文を継ぎ足すと二重レポートに
+                # なるため、部分出力後はフォールバックせずエラーとして打ち切る
+                yield f"\n\n{GEMINI_ERROR_PREFIX}（生成が途中で中断されました）: {last_error}"
+                return
+            continue
 
-### 【詳細分析レポート】
+    yield f"{GEMINI_ERROR_PREFIX}（全モデルで失敗）: {last_error}"
 
-#### 1. 分節音レベルの評価
-(母音・子音の歪み、母語干渉など)
 
-#### 2. プロソディ（超分節音）レベルの評価
-* **拍と音節**: 
-  [分析コメント]
-* **韻律とフット**: 
-  [分析コメント]
-* **アクセントとイントネーション**: 
-  [分析コメント]
+def evaluate_one(file_bytes, student_name, nationality):
+    """1ファイル分の認識→レポート生成（バッチ評価のワーカースレッドから呼ぶ）"""
+    res = analyze_audio(file_bytes)
+    if "error" in res:
+        return res
+    report = "".join(ask_gemini(
+        student_name, nationality, res["main_text"], res["alts"],
+        details_for_prompt(res["word_data"], res["details"])
+    ))
+    return {"res": res, "report": report}
 
-#### 3. 指導アドバイス・練習計画
-"""
-    
-    for model_name in target_models:
-        try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
-            return response.text
-            
-        except Exception as e:
-            last_error = e
-            continue
-    
-    return f"❌ Gemini生成エラー（全モデルで失敗）: {last_error}"
+
+# サマリー抽出用の正規表現（レポートのたびに再コンパイルしない）
+SCORE_RE = re.compile(r'スコア.*?:.*?(\d{1,3})')
+CLARITY_RE = re.compile(r'明瞭度.*?:.*?([SABC])', re.IGNORECASE)
+NATURAL_RE = re.compile(r'日本語らしさ.*?:.*?([SABC])', re.IGNORECASE)
+
+# 表記ゆれの正規化テーブル（コロン統一・スペース削除を1パスで行う）
+SUMMARY_NORMALIZE = str.maketrans({"：": ":", " ": None, "　": None})
+
+# サマリーブロック（見出しから区切り線まで）を1スキャンで切り出す
+SUMMARY_BLOCK_RE = re.compile(r'(?:###\s*)?【総合評価サマリー】.*?(?=\n---|\Z)', re.DOTALL)
 
 
 def parse_summary(report_text):
     """
     レポートからサマリー情報を抽出する（強化版：表記ゆれ対応）
     """
-    # 抽出を容易にするため、記号を統一
-    clean_text = report_text.replace("**", "")  # 太字記号削除
-    clean_text = clean_text.replace("：", ":")  # コロン統一
-    clean_text = clean_text.replace(" ", "")    # スペース削除
-    
+    # 抽出を容易にするため、記号を統一（太字記号の削除後は1パスのtranslateで正規化）
+    clean_text = report_text.replace("**", "").translate(SUMMARY_NORMALIZE)
+
     # 正規表現で抽出（より柔軟に）
     # "スコア"の後ろにある数字 (0-100) を探す
-    score_match = re.search(r'スコア.*?:.*?(\d{1,3})', clean_text)
-    
+    score_match = SCORE_RE.search(clean_text)
+
     # "明瞭度"の後ろにある S,A,B,C を探す
-    clarity_match = re.search(r'明瞭度.*?:.*?([SABC])', clean_text, re.IGNORECASE)
-    
+    clarity_match = CLARITY_RE.search(clean_text)
+
     # "日本語らしさ"の後ろにある S,A,B,C を探す
-    natural_match = re.search(r'日本語らしさ.*?:.*?([SABC])', clean_text, re.IGNORECASE)
-    
-    # サマリー本文の抽出
-    summary_block = "サマリー抽出失敗"
-    try:
-        start = report_text.find("### 【総合評価サマリー】")
-        if start == -1: start = report_text.find("【総合評価サマリー】")
-        
-        end = report_text.find("---", start)
-        if start != -1 and end != -1:
-            summary_block = report_text[start:end].strip()
-    except:
-        pass
+    natural_match = NATURAL_RE.search(clean_text)
     
+    # サマリー本文の抽出（find×3ではなく正規表現1回で切り出す）
+    block_match = SUMMARY_BLOCK_RE.search(report_text)
+    summary_block = block_match.group(0).strip() if block_match else "サマリー抽出失敗"
+
     return {
         "score": score_match.group(1) if score_match else "0",
         "clarity": clarity_match.group(1).upper() if clarity_match else "-",
@@ -313,109 +754,153 @@ def parse_summary(report_text):
     }
 
 
-def save_to_sheet(data_dict):
-    """Google スプレッドシートにデータを保存"""
+@st.cache_resource
+def get_sheet():
+    """認証済みワークシートを一度だけ開いて使い回す（認証・open_by_urlは保存のたびに不要）"""
+    import gspread  # 保存が起きるまで読み込まない（初回起動のimport時間を削る）
+
+    scopes = [
+        'https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive'
+    ]
+    creds = service_account.Credentials.from_service_account_info(
+        google_creds_dict,
+        scopes=scopes
+    )
+    client = gspread.authorize(creds)
+    return client.open_by_url(st.secrets["SHEET_URL"]).sheet1
+
+
+def build_sheet_row(data_dict):
+    """保存用の1行を組み立てる"""
+    return [
+        data_dict["date"],
+        data_dict["name"],
+        data_dict["nationality"],
+        data_dict["score"],
+        data_dict["clarity"],
+        data_dict["naturalness"],
+        data_dict["summary_text"]
+    ]
+
+
+def save_rows_to_sheet(rows):
+    """複数行をまとめて1回のAPI呼び出しで保存（行ごとの往復を避ける）"""
     try:
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = service_account.Credentials.from_service_account_info(
-            google_creds_dict, 
-            scopes=scopes
-        )
-        client = gspread.authorize(creds)
-        
-        sheet_url = st.secrets.get("SHEET_URL")
-        if not sheet_url:
+        if not st.secrets.get("SHEET_URL"):
             return False, "SHEET_URL未設定"
-        
-        sheet = client.open_by_url(sheet_url).sheet1
-        
-        row = [
-            data_dict["date"],
-            data_dict["name"],
-            data_dict["nationality"],
-            data_dict["score"],
-            data_dict["clarity"],
-            data_dict["naturalness"],
-            data_dict["summary_text"]
-        ]
-        
-        sheet.append_row(row)
+        if not rows:
+            return True, "成功"
+
+        get_sheet().append_rows(rows, value_input_option='RAW')
         return True, "成功"
-        
+
     except Exception as e:
         return False, str(e)
 
 
-def render_sticky_player_and_buttons(audio_content, word_data):
+def save_to_sheet(data_dict):
+    """Google スプレッドシートにデータを保存"""
+    return save_rows_to_sheet([build_sheet_row(data_dict)])
+
+
+def render_sticky_player_and_buttons(audio_content, low_conf_words, audio_format="audio/mp3"):
     """固定プレーヤーと低信頼度箇所へのジャンプボタンを表示（HTMLバグ完全修正版）"""
-    b64_audio = base64.b64encode(audio_content).decode()
-    buttons_html = ""
     unique_id = int(datetime.datetime.now().timestamp() * 1000)
-    
-    low_conf_count = 0
-    for item in word_data:
-        if item['conf'] < 0.8:
-            start = item['start']
-            word = item['word']
-            conf = int(item['conf'] * 100)
-            
-            # HTMLタグを1行で生成
-            btn = f'<button class="seek-btn-{unique_id}" data-seek="{start}" style="background-color:#ffffff;border:1px solid #d3d3d3;border-radius:5px;padding:6px 12px;cursor:pointer;color:#d9534f;font-weight:bold;font-size:14px;display:inline-flex;align-items:center;gap:5px;margin:4px;">▶ {word} <span style="font-size:12px;color:#666;font-weight:normal;">({conf}%)</span></button>'
-            buttons_html += btn
-            low_conf_count += 1
-    
-    if low_conf_count == 0:
-        buttons_html = "<div style='color:#666;padding:10px;'>✅ 低信頼度の箇所なし（明瞭な発音）</div>"
 
-    # コンテナHTMLも1行につなげて表示
-    container_html = f'<div style="background-color:#fff3cd;border:1px solid #ffeeba;border-radius:8px;padding:15px;margin-bottom:20px;"><div style="color:#856404;font-weight:bold;margin-bottom:10px;">⚠️ 低信頼度箇所（クリックで再生）</div><div>{buttons_html}</div></div>'
-    
+    # ボタンはHTMLを単語数ぶん複製せず、JSONデータ1本をJS側で展開する
+    # （インラインCSSを共有クラスにまとめ、WebSocketに流すHTML量を抑える）
+    payload = json.dumps(
+        [{"w": item["word"], "s": round(item["start"], 2), "c": item["conf"]}
+         for item in low_conf_words],
+        ensure_ascii=False
+    )
+
+    placeholder_html = "" if low_conf_words else NO_LOW_CONF_HTML
+
+    # コンテナHTMLも1行につなげて表示（ボタンの共通スタイルは1箇所で定義）
+    container_html = (
+        f'<style>.seek-btn-{unique_id}{{background-color:#ffffff;border:1px solid #d3d3d3;border-radius:5px;padding:6px 12px;cursor:pointer;color:#d9534f;font-weight:bold;font-size:14px;display:inline-flex;align-items:center;gap:5px;margin:4px;}}'
+        f'.seek-btn-{unique_id} span{{font-size:12px;color:#666;font-weight:normal;}}</style>'
+        f'<div style="background-color:#fff3cd;border:1px solid #ffeeba;border-radius:8px;padding:15px;margin-bottom:20px;"><div style="color:#856404;font-weight:bold;margin-bottom:10px;">⚠️ 低信頼度箇所（クリックで再生）</div><div id="seek-btns-{unique_id}">{placeholder_html}</div></div>'
+    )
+
     st.markdown(container_html, unsafe_allow_html=True)
 
     # 固定プレーヤー
-    html_code = f"""
-    <div id="sticky-audio-container-{unique_id}" style="position:fixed;bottom:0;left:0;width:100%;background-color:#f1f3f5;border-top:1px solid #dee2e6;padding:10px 0;text-align:center;box-shadow:0 -2px 10px rgba(0,0,0,0.1);z-index:999999;">
-        <div style="font-size:12px;color:#666;margin-bottom:4px;font-weight:bold;">🔊 音声プレーヤー (レポート閲覧中もここに固定されます)</div>
-        <audio id="audio-player-{unique_id}" controls style="width:90%;max-width:600px;">
-            <source src="data:audio/mp3;base64,{b64_audio}" type="audio/mp3">
-        </audio>
-    </div>
+    # 音声はbase64データURLではなくStreamlitのメディアエンドポイントから配信する
+    # （st.audioはバイト列を内部のメディアファイルストレージ経由でURL配信するため、
+    #   ページHTMLに全音声を埋め込まずに済む）
+    st.markdown(STICKY_PLAYER_CSS, unsafe_allow_html=True)
+    with st.container(key="sticky_player"):
+        st.markdown(STICKY_PLAYER_LABEL, unsafe_allow_html=True)
+        st.audio(audio_content, format=audio_format)
+
+    # ジャンプボタンと親ドキュメント側プレーヤーの接続
+    js_code = f"""
     <script>
         (function() {{
-            var frame = window.frameElement;
-            if (frame) {{
-                frame.style.position = "fixed";
-                frame.style.bottom = "0";
-                frame.style.left = "0";
-                frame.style.width = "100%";
-                frame.style.height = "100px";
-                frame.style.zIndex = "999999";
-                frame.style.border = "none";
-            }}
+            var parentDoc = window.parent.document;
+            var WORDS = {payload};
             function setupInteraction() {{
-                var player = document.getElementById("audio-player-{unique_id}");
-                if (!player) return;
-                var parentDoc = window.parent.document;
-                var buttons = parentDoc.getElementsByClassName("seek-btn-{unique_id}");
-                for (var i = 0; i < buttons.length; i++) {{
-                    buttons[i].onclick = function() {{
-                        var seekTime = parseFloat(this.getAttribute("data-seek"));
-                        player.currentTime = seekTime;
+                var wrap = parentDoc.querySelector(".st-key-sticky_player");
+                if (!wrap) return false;
+                var player = wrap.querySelector("audio");
+                if (!player) return false;
+                var holder = parentDoc.getElementById("seek-btns-{unique_id}");
+                if (!holder) return false;
+                if (!holder.dataset.built) {{
+                    holder.dataset.built = "1";
+                    for (var i = 0; i < WORDS.length; i++) {{
+                        var btn = parentDoc.createElement("button");
+                        btn.className = "seek-btn-{unique_id}";
+                        btn.setAttribute("data-seek", WORDS[i].s);
+                        btn.textContent = "▶ " + WORDS[i].w + " ";
+                        var conf = parentDoc.createElement("span");
+                        conf.textContent = "(" + WORDS[i].c + "%)";
+                        btn.appendChild(conf);
+                        holder.appendChild(btn);
+                    }}
+                    // 個別のonclickではなく、親要素1つに委譲したリスナーで拾う
+                    holder.addEventListener("click", function(e) {{
+                        var btn = e.target.closest(".seek-btn-{unique_id}");
+                        if (!btn) return;
+                        player.currentTime = parseFloat(btn.getAttribute("data-seek"));
                         player.play();
-                    }};
+                    }});
                 }}
+                return true;
+            }}
+            // ポーリング（setInterval）ではなくDOMの変化を監視して接続する。
+            // プレーヤーとボタン置き場が揃った時点で1回だけ構築し、監視を止める。
+            if (!setupInteraction()) {{
+                var observer = new MutationObserver(function() {{
+                    if (setupInteraction()) observer.disconnect();
+                }});
+                observer.observe(parentDoc.body, {{childList: true, subtree: true}});
             }}
-            setTimeout(setupInteraction, 1000);
-            setInterval(setupInteraction, 2000);
         }})();
     </script>
     """
-    
-    components.html(html_code, height=0)
 
+    components.html(js_code, height=0)
+
+
+@st.cache_resource
+def warm_start():
+    """初回クリック前にffmpegバイナリとSTTチャネルを温める（プロセスごとに1回）"""
+    try:
+        subprocess.run(["ffmpeg", "-version"], capture_output=True, timeout=10)
+    except Exception:
+        pass
+    try:
+        get_speech_client()
+    except Exception:
+        pass
+    return True
+
+
+warm_start()
 
 # --- メイン処理 ---
 st.info("👇 学習者の情報を入力してください（任意）")
@@ -432,22 +917,29 @@ st.divider()
 tab1, tab2 = st.tabs(["📁 ファイルアップロード", "🎙️ 録音"])
 
 target_file = None
+batch_files = []
 
 with tab1:
-    uploaded_file = st.file_uploader(
-        "音声/動画ファイルを選択", 
-        type=["mp3", "wav", "m4a", "mp4", "mov"]
+    uploaded_files = st.file_uploader(
+        "音声/動画ファイルを選択（複数選択でクラス一括評価）",
+        type=["mp3", "wav", "m4a", "mp4", "mov"],
+        accept_multiple_files=True
     )
-    
-    if uploaded_file:
-        file_ext = uploaded_file.name.split('.')[-1].lower()
-        
-        if file_ext in ['mp4', 'mov']:
-            st.video(uploaded_file)
+
+    if uploaded_files:
+        if len(uploaded_files) == 1:
+            uploaded_file = uploaded_files[0]
+            file_ext = uploaded_file.name.split('.')[-1].lower()
+
+            if file_ext in ['mp4', 'mov']:
+                st.video(uploaded_file)
+            else:
+                st.audio(uploaded_file)
+
+            target_file = uploaded_file
         else:
-            st.audio(uploaded_file)
-        
-        target_file = uploaded_file
+            st.info(f"📦 {len(uploaded_files)}件のファイルを一括評価します")
+            batch_files = uploaded_files
 
 with tab2:
     recorded_audio = st.audio_input("🎤 録音開始（クリックして話してください）")
@@ -460,127 +952,224 @@ st.divider()
 
 # 分析実行ボタン
 if st.button("🚀 音声評価を開始する", type="primary", use_container_width=True):
-    if not target_file:
+    if batch_files:
+        # 一括評価：ボトルネックは2つの外部APIのI/O待ちなのでスレッドで並列化する
+        with st.spinner(f'🎧 {len(batch_files)}件を並列評価中...'):
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(4, len(batch_files))
+            ) as pool:
+                futures = [
+                    pool.submit(evaluate_one, f.getvalue(), student_name, nationality)
+                    for f in batch_files
+                ]
+                outcomes = [fut.result() for fut in futures]
+
+        st.session_state["batch"] = {
+            "names": [f.name for f in batch_files],
+            "outcomes": outcomes,
+            "student_name": student_name,
+            "nationality": nationality,
+            "now_jst": get_jst_now(),
+            "saved": False
+        }
+        st.session_state.pop("eval", None)
+    elif not target_file:
         st.warning("⚠️ 音声ファイルを選択するか、録音してください。")
     else:
         with st.spinner('🎧 音声を分析中...（最大10分程度かかる場合があります）'):
-            # 一時ファイルに保存
-            file_bytes = target_file.getvalue()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-            
-            # 音声認識実行
-            res = analyze_audio(tmp_path)
-            
-            # 一時ファイル削除
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            
-            # エラーチェック
-            if "error" in res:
-                st.error(f"❌ {res['error']}")
-                st.info("💡 音声が明瞭か、ファイル形式が対応しているか確認してください。")
-            else:
-                st.success("✅ 音声解析完了！")
-                
-                # プレーヤーとジャンプボタン
-                render_sticky_player_and_buttons(res["audio_content"], res["word_data"])
-                
-                # 認識結果表示
-                st.markdown(
-                    f"""
-                    <div style="background-color:#f8f9fa;
-                                padding:15px;
-                                border-radius:8px;
-                                margin-bottom:20px;">
-                        <strong>📝 認識結果</strong><br>
-                        <span style="font-size:16px;">{res["main_text"]}</span>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
+            # 同一ファイルならリランをまたいでバイト列を再実体化しない
+            # （file_idはアップロード・録音のたびに変わるため、同名ファイルの
+            #   再アップロードや録音の取り直しを確実に区別できる）
+            file_key = target_file.file_id
+            if st.session_state.get("upload_key") != file_key:
+                st.session_state["upload_bytes"] = target_file.getvalue()
+                st.session_state["upload_key"] = file_key
+            file_bytes = st.session_state["upload_bytes"]
+            audio_sha = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+            # 音声認識の待ち時間中にGeminiのモデル解決を裏で温めておく
+            # （結果はst.cache_resourceに載るので後段のask_geminiが即座に使える）
+            warmup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            warmup_executor.submit(resolve_gemini_models)
+
+            # 音声認識実行（同一ファイルの再クリックはキャッシュが返る）
+            # ストリーミング認識の途中経過はプレースホルダに逐次表示する
+            live_text = st.empty()
+            try:
+                res = cached_analyze_audio(
+                    audio_sha,
+                    file_bytes,
+                    lambda t: live_text.markdown(f"📝 認識中: {t}")
                 )
-                
-                # 詳細データ
-                with st.expander("🔍 詳細データ（単語別信頼度）"):
-                    st.write(res['details'])
-                
-                # Gemini分析
-                with st.spinner('🤖 AI評価レポートを生成中...'):
-                    report = ask_gemini(
-                        student_name, 
-                        nationality, 
-                        res["main_text"], 
-                        res["alts"], 
-                        res["details"]
-                    )
-                
-                # レポート表示
-                st.markdown("---")
-                st.markdown("## 📊 音声評価レポート")
-                st.markdown(report)
-                
-                # スプレッドシート保存
-                parsed = parse_summary(report)
-                
-                if parsed["score"] != "0":
-                    with st.spinner("💾 データを保存中..."):
-                        now_jst = get_jst_now()
-                        save_data = {
-                            "date": now_jst.strftime('%Y-%m-%d %H:%M'),
-                            "name": student_name or "匿名",
-                            "nationality": nationality or "不明",
-                            **parsed
-                        }
-                        
-                        ok, msg = save_to_sheet(save_data)
-                        
-                        if ok:
-                            st.toast("✅ スプレッドシートに保存しました", icon="✅")
-                        else:
-                            st.warning(f"⚠️ 保存失敗: {msg}")
-                else:
-                    st.warning("⚠️ スコアの自動抽出に失敗しましたが、レポートは正常に生成されています。")
+            except AnalysisError as e:
+                res = {"error": str(e)}
+            live_text.empty()
+            warmup_executor.shutdown(wait=False)
 
-                # ダウンロードボタン
-                now_jst = get_jst_now()
-                st.markdown("---")
-                download_text = f"""
-日本語音声評価レポート
-====================
+        # エラーチェック
+        if "error" in res:
+            st.error(f"❌ {res['error']}")
+            st.info("💡 音声が明瞭か、ファイル形式が対応しているか確認してください。")
+        else:
+            st.success("✅ 音声解析完了！")
+            # 結果をセッションに保持し、ダウンロード等によるリランでも
+            # 認識・レポート生成・シート保存を繰り返さない
+            st.session_state["eval"] = {
+                "res": res,
+                "student_name": student_name,
+                "nationality": nationality,
+                "report": None,
+                "saved": False,
+                "now_jst": get_jst_now()
+            }
+            st.session_state.pop("batch", None)
 
-【評価日時】 {now_jst.strftime('%Y年%m月%d日 %H:%M')} (JST)
-【学習者名】 {student_name or '匿名'}
-【母語】 {nationality or '不明'}
+# 評価結果の表示（リランをまたいでst.session_stateから復元される）
+if "eval" in st.session_state:
+    ev = st.session_state["eval"]
+    res = ev["res"]
 
-【認識結果】
-{res['main_text']}
+    # プレーヤーとジャンプボタン
+    render_sticky_player_and_buttons(
+        res["audio_content"], res["low_conf_words"], res.get("audio_format", "audio/mp3")
+    )
 
-【評価レポート】
-{report}
+    # 認識結果表示
+    st.markdown(
+        f"""
+        <div style="background-color:#f8f9fa;
+                    padding:15px;
+                    border-radius:8px;
+                    margin-bottom:20px;">
+            <strong>📝 認識結果</strong><br>
+            <span style="font-size:16px;">{res["main_text"]}</span>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
 
----
-生成元: 日本語音声指導補助ツール v6.9
-"""
-                
-                st.download_button(
-                    label="📥 レポートをダウンロード",
-                    data=download_text,
-                    file_name=f"{student_name or '匿名'}_音声評価_{now_jst.strftime('%Y%m%d_%H%M%S')}.txt",
-                    mime="text/plain",
-                    use_container_width=True
-                )
-                
-                # 下部に余白を追加（プレーヤーが被らないように）
-                st.markdown("<br><br><br><br>", unsafe_allow_html=True)
+    # 詳細データ
+    with st.expander("🔍 詳細データ（単語別信頼度）"):
+        st.write(res['details'])
+
+    # Gemini分析（初回はチャンクが届き次第逐次表示、以降は保持済みを表示）
+    st.markdown("---")
+    st.markdown("## 📊 音声評価レポート")
+    if ev["report"] is None:
+        ev["report"] = st.write_stream(stream_report(
+            ev["student_name"],
+            ev["nationality"],
+            res["main_text"],
+            res["alts"],
+            details_for_prompt(res["word_data"], res["details"])
+        ))
+    else:
+        st.markdown(ev["report"])
+    report = ev["report"]
+    now_jst = ev["now_jst"]
+
+    # スプレッドシート保存（セッション内で1回だけ）
+    # ネットワーク往復をバックグラウンドに逃がし、その間に後続のUIを描画する
+    parsed = parse_summary(report)
+    save_future = None
+
+    if parsed["score"] != "0":
+        if not ev["saved"]:
+            save_data = {
+                "date": now_jst.strftime('%Y-%m-%d %H:%M'),
+                "name": ev["student_name"] or "匿名",
+                "nationality": ev["nationality"] or "不明",
+                **parsed
+            }
+            save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            save_future = save_executor.submit(save_to_sheet, save_data)
+            save_executor.shutdown(wait=False)
+    else:
+        st.warning("⚠️ スコアの自動抽出に失敗しましたが、レポートは正常に生成されています。")
+
+    # ダウンロードボタン（本文は評価ごとに1回だけ組み立ててセッションに保持）
+    st.markdown("---")
+    if ev.get("download_text") is None:
+        ev["download_text"] = "".join([
+            "\n日本語音声評価レポート\n",
+            "====================\n\n",
+            "【評価日時】 ", now_jst.strftime('%Y年%m月%d日 %H:%M'), " (JST)\n",
+            "【学習者名】 ", ev["student_name"] or '匿名', "\n",
+            "【母語】 ", ev["nationality"] or '不明', "\n\n",
+            "【認識結果】\n", res['main_text'], "\n\n",
+            "【評価レポート】\n", report, "\n\n",
+            "---\n",
+            "生成元: 日本語音声指導補助ツール v6.9\n"
+        ])
+    download_text = ev["download_text"]
+
+    st.download_button(
+        label="📥 レポートをダウンロード",
+        data=download_text,
+        file_name=f"{ev['student_name'] or '匿名'}_音声評価_{now_jst.strftime('%Y%m%d_%H%M%S')}.txt",
+        mime="text/plain",
+        use_container_width=True
+    )
+
+    # バックグラウンド保存の結果を回収
+    if save_future is not None:
+        ok, msg = save_future.result()
+        if ok:
+            ev["saved"] = True
+            st.toast("✅ スプレッドシートに保存しました", icon="✅")
+        else:
+            st.warning(f"⚠️ 保存失敗: {msg}")
+
+    # 下部に余白を追加（プレーヤーが被らないように）
+    st.markdown("<br><br><br><br>", unsafe_allow_html=True)
+
+# 一括評価の結果表示（リランをまたいで保持される）
+if "batch" in st.session_state:
+    batch = st.session_state["batch"]
+    now_jst = batch["now_jst"]
+    st.markdown("---")
+    st.markdown("## 📊 一括評価結果")
+
+    for i, (name, outcome) in enumerate(zip(batch["names"], batch["outcomes"])):
+        with st.expander(f"📄 {name}"):
+            if "error" in outcome:
+                st.error(f"❌ {outcome['error']}")
+                continue
+
+            res = outcome["res"]
+            st.audio(res["audio_content"], format=res.get("audio_format", "audio/mp3"))
+            st.markdown(f"**📝 認識結果**: {res['main_text']}")
+            st.markdown(outcome["report"])
+            st.download_button(
+                label="📥 レポートをダウンロード",
+                data=outcome["report"],
+                file_name=f"{name}_音声評価_{now_jst.strftime('%Y%m%d_%H%M%S')}.txt",
+                mime="text/plain",
+                key=f"batch_dl_{i}"
+            )
+
+    # シート保存は一括分を1リクエストにまとめて1回だけ
+    if not batch["saved"]:
+        with st.spinner("💾 データを保存中..."):
+            rows = []
+            for name, outcome in zip(batch["names"], batch["outcomes"]):
+                if "error" in outcome:
+                    continue
+                parsed = parse_summary(outcome["report"])
+                if parsed["score"] == "0":
+                    continue
+                rows.append(build_sheet_row({
+                    "date": now_jst.strftime('%Y-%m-%d %H:%M'),
+                    "name": batch["student_name"] or name,
+                    "nationality": batch["nationality"] or "不明",
+                    **parsed
+                }))
+            ok, msg = save_rows_to_sheet(rows)
+        if ok:
+            batch["saved"] = True
+        else:
+            st.warning(f"⚠️ 保存失敗: {msg}")
 
 # フッター
 st.markdown("---")
-st.markdown(
-    """
-    <div style="text-align: center; color: #666; font-size: 0.8em;">
-        Mirait Japanese Academy 日本語音声指導補助ツール v7.1 | Powered by Google Cloud Speech-to-Text & Gemini AI
-    </div>
-    """,
-    unsafe_allow_html=True
-)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)